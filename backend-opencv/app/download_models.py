@@ -1,34 +1,61 @@
+import logging
 import os
+import shutil
 import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# Streaming copy buffer; urlretrieve's small internal chunks throttle
+# throughput on large model files
+DOWNLOAD_CHUNK_SIZE = 1 << 20
 
 def download_file(url, filename):
-    print(f"Downloading {filename}...")
-    urllib.request.urlretrieve(url, filename)
-    print(f"Downloaded {filename}")
+    logger.info("Downloading %s...", filename)
+    with urllib.request.urlopen(url) as response, open(filename, 'wb') as f:
+        shutil.copyfileobj(response, f, length=DOWNLOAD_CHUNK_SIZE)
+    logger.info("Downloaded %s", filename)
 
 def main():
     # Create models directory if it doesn't exist
     os.makedirs('models', exist_ok=True)
-    
+
     # Model files URLs
     model_files = {
         'deploy.prototxt': 'https://raw.githubusercontent.com/opencv/opencv/master/samples/dnn/face_detector/deploy.prototxt',
         'res10_300x300_ssd_iter_140000.caffemodel': 'https://raw.githubusercontent.com/opencv/opencv_3rdparty/dnn_samples_face_detector_20170830/res10_300x300_ssd_iter_140000.caffemodel'
     }
-    
-    # Download each model file
-    for filename, url in model_files.items():
-        filepath = os.path.join('models', filename)
-        if not os.path.exists(filepath):
-            try:
-                download_file(url, filepath)
-            except Exception as e:
-                print(f"Error downloading {filename}: {str(e)}")
-                print("Please download the model files manually and place them in the 'models' directory:")
-                print("1. deploy.prototxt")
-                print("2. res10_300x300_ssd_iter_140000.caffemodel")
-                return False
-    return True
+
+    # Download the missing model files in parallel so total setup time is
+    # bounded by the largest file, not the sum of all of them
+    missing = {
+        filename: url for filename, url in model_files.items()
+        if not os.path.exists(os.path.join('models', filename))
+    }
+    if not missing:
+        return True
+
+    with ThreadPoolExecutor(max_workers=len(missing)) as executor:
+        futures = {
+            filename: executor.submit(download_file, url, os.path.join('models', filename))
+            for filename, url in missing.items()
+        }
+
+    success = True
+    for filename, future in futures.items():
+        try:
+            future.result()
+        except Exception as e:
+            logger.error("Error downloading %s: %s", filename, e)
+            success = False
+
+    if not success:
+        logger.error("Please download the model files manually and place them in the 'models' directory:")
+        logger.error("1. deploy.prototxt")
+        logger.error("2. res10_300x300_ssd_iter_140000.caffemodel")
+
+    return success
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
     main()
@@ -1,52 +1,244 @@
+import multiprocessing
+
+# Force the spawn start method before anything below loads dlib: workers
+# forked after a CUDA context exists inherit a corrupted copy of it, which
+# surfaces as silent slowdowns rather than errors. Spawned workers start
+# from a clean interpreter instead.
+try:
+    multiprocessing.set_start_method('spawn', force=True)
+except RuntimeError:
+    pass
+
+import asyncio
+import bisect
+import hashlib
+import logging
 import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import cv2
 import numpy as np
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel
 import base64
+import dlib
 import face_recognition
-from typing import Tuple, List, Dict, Optional
+from typing import List, Dict
+
+logger = logging.getLogger(__name__)
+
+# dlib throughput depends heavily on how the wheel was built: without CUDA
+# the CNN detector falls back to the CPU (an order of magnitude slower),
+# and builds without AVX slow every stage. Surface this once at import so
+# a slow deployment is visible instead of silent.
+DLIB_USE_CUDA = bool(getattr(dlib, 'DLIB_USE_CUDA', False))
+
+if not DLIB_USE_CUDA:
+    logger.warning(
+        "dlib was built without CUDA support; CNN face detection will run "
+        "on the CPU and be substantially slower"
+    )
+
+if not getattr(dlib, 'USE_AVX_INSTRUCTIONS', True):
+    logger.warning(
+        "dlib was built without AVX instructions; detection and encoding "
+        "will be several times slower than an AVX-enabled build"
+    )
+
+if not getattr(dlib, 'DLIB_USE_BLAS', True):
+    logger.warning(
+        "dlib was built without a BLAS library; the ResNet encoding "
+        "forward pass will be dramatically slower"
+    )
 
-app = FastAPI()
+# orjson serializes the large base64 payloads several times faster than
+# the stdlib json encoder FastAPI uses by default
+app = FastAPI(default_response_class=ORJSONResponse)
+
+# Enable CORS. Origins are configurable so production deployments with a
+# known frontend can hand Starlette a finite set (its fast-path membership
+# check) instead of wildcard matching; methods and headers are the finite
+# tuples this API actually uses, which keeps preflight handling off the
+# wildcard path entirely.
+ALLOW_ORIGINS = tuple(os.environ.get("ALLOW_ORIGINS", "*").split(","))
 
-# Enable CORS
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
+    allow_origins=ALLOW_ORIGINS,
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=("GET", "POST", "OPTIONS"),
+    allow_headers=("content-type",),
 )
 
-def decode_base64_image(base64_string):
+# Longest image edge used for face detection. Detection cost is linear in
+# pixel count and faces stay detectable well below this resolution, so
+# scanning phone-camera uploads at native size is wasted work.
+MAX_DETECTION_EDGE = 800
+
+# Longest edge of the face crops kept in detection results (and therefore
+# in the detection cache). The crops exist only for display, so anything
+# above this is wasted memory; without the cap a near-full-frame face can
+# pin a multi-megabyte crop per cache entry.
+MAX_ROI_EDGE = 320
+
+def downscale_for_detection(image):
+    """Downscale image for detection, returning (small_image, scale)"""
+    height, width = image.shape[:2]
+    scale = min(1.0, MAX_DETECTION_EDGE / max(height, width))
+    if scale >= 1.0:
+        return image, 1.0
+    small = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    return small, scale
+
+def scale_face_locations(face_locations, scale):
+    """Map (top, right, bottom, left) boxes from the downscaled image back to full resolution"""
+    if scale >= 1.0:
+        return face_locations
+    return [tuple(round(coord / scale) for coord in location) for location in face_locations]
+
+def detect_face_locations(rgb_small, cnn_upsample):
+    """Detect faces on the downscaled RGB image, preferring CNN on CUDA builds"""
+    # CNN only on CUDA builds; on the CPU the CNN detector is an order of
+    # magnitude slower than HOG
+    face_locations = []
+    if DLIB_USE_CUDA:
+        face_locations = face_recognition.face_locations(
+            rgb_small, model="cnn", number_of_times_to_upsample=cnn_upsample)
+
+    # Fall back to HOG when CNN is unavailable or finds no faces
+    if not face_locations:
+        face_locations = face_recognition.face_locations(
+            rgb_small, model="hog", number_of_times_to_upsample=2)
+
+    return face_locations
+
+def face_area(location):
+    """Pixel area of a (top, right, bottom, left) face location"""
+    return (location[2] - location[0]) * (location[1] - location[3])
+
+def face_box(top, right, bottom, left):
+    """Build the response box dict from a (top, right, bottom, left) location"""
+    return {
+        'x': int(left),
+        'y': int(top),
+        'width': int(right - left),
+        'height': int(bottom - top)
+    }
+
+# pybase64 decodes base64 through SSSE3/AVX kernels at multiple GB/s,
+# an order of magnitude faster than the stdlib on multi-MB uploads; fall
+# back to the stdlib decoder when it isn't installed
+try:
+    import pybase64 as _base64
+except ImportError:
+    _base64 = base64
+
+def decode_base64_bytes(base64_string):
     if 'base64,' in base64_string:
-        base64_string = base64_string.split('base64,')[1]
-    image_bytes = base64.b64decode(base64_string)
+        base64_string = base64_string.partition('base64,')[2]
+    return _base64.b64decode(base64_string)
+
+# Large JPEGs are decoded at reduced scale straight from the DCT
+# coefficients (libjpeg-turbo's decimated IDCT), which is several times
+# cheaper than a full decode. Faces stay comfortably detectable at these
+# scales given the uploads such payload sizes imply; thresholds are on
+# the compressed payload size.
+REDUCED_DECODE_2_BYTES = 2 << 20
+REDUCED_DECODE_4_BYTES = 8 << 20
+
+def imdecode_scaled(image_bytes):
+    """Decode image bytes, returning (image, decode_scale); boxes measured
+    on the decoded image divide by decode_scale to reach original
+    coordinates"""
+    if len(image_bytes) >= REDUCED_DECODE_4_BYTES:
+        flags, decode_scale = cv2.IMREAD_REDUCED_COLOR_4, 0.25
+    elif len(image_bytes) >= REDUCED_DECODE_2_BYTES:
+        flags, decode_scale = cv2.IMREAD_REDUCED_COLOR_2, 0.5
+    else:
+        flags, decode_scale = cv2.IMREAD_COLOR, 1.0
+
     nparr = np.frombuffer(image_bytes, np.uint8)
-    image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-    return image
+    image = cv2.imdecode(nparr, flags)
+    return image, decode_scale
+
+def rescale_boxes(result, decode_scale):
+    """Map detection boxes from reduced-decode coordinates back to the
+    original image so response boxes always match the uploaded pixels"""
+    inv = 1.0 / decode_scale
+
+    def rescale(box):
+        return {key: round(value * inv) for key, value in box.items()}
+
+    if isinstance(result, list):
+        return [dict(face, box=rescale(face['box'])) for face in result]
+
+    face_roi, face_encoding, detection = result
+    return face_roi, face_encoding, dict(detection, box=rescale(detection['box']))
+
+# Detection results cached by image content hash. Verification flows
+# resubmit the same ID card image over and over; a hit skips base64 decode
+# aside, the entire detect + encode pipeline. Entries store encodings and
+# face crops bounded to MAX_ROI_EDGE, so the cache stays small.
+DETECTION_CACHE_SIZE = 256
+
+_detection_cache = OrderedDict()
+_detection_cache_lock = threading.Lock()
+
+# Dedicated executor for the decode + detect stage, sized to the core
+# count. Each task saturates roughly one core inside dlib, so a bounded
+# pool keeps a burst of requests queued at the pipeline's bottleneck
+# stage instead of oversubscribing the CPU and inflating tail latency.
+_detection_executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 4)
+
+def detect_with_cache(kind, base64_string, detect):
+    """Decode the image and run detect on it, caching results by content hash"""
+    image_bytes = decode_base64_bytes(base64_string)
+    key = (kind, hashlib.blake2b(image_bytes, digest_size=16).digest())
+
+    with _detection_cache_lock:
+        if key in _detection_cache:
+            _detection_cache.move_to_end(key)
+            return _detection_cache[key]
+
+    image, decode_scale = imdecode_scaled(image_bytes)
+    result = detect(image)
+    if decode_scale < 1.0:
+        result = rescale_boxes(result, decode_scale)
+
+    with _detection_cache_lock:
+        _detection_cache[key] = result
+        _detection_cache.move_to_end(key)
+        while len(_detection_cache) > DETECTION_CACHE_SIZE:
+            _detection_cache.popitem(last=False)
+
+    return result
 
 def detect_face_id(image):
     """Detect face in ID card image"""
     if image is None:
         raise HTTPException(status_code=400, detail="Invalid image data")
     
-    # Convert BGR to RGB
+    # Convert BGR to RGB once; the detection copy is resized from the
+    # already-converted image rather than converted a second time
     rgb_image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-    
-    # Try CNN model first for better accuracy
-    face_locations = face_recognition.face_locations(rgb_image, model="cnn", number_of_times_to_upsample=0)
-    
-    # If CNN fails or finds no faces, try HOG model with different parameters
-    if not face_locations:
-        face_locations = face_recognition.face_locations(rgb_image, model="hog", number_of_times_to_upsample=2)
-    
+
+    # Detect on a downscaled copy; encoding and ROI extraction below still
+    # use the full-resolution image
+    rgb_small, scale = downscale_for_detection(rgb_image)
+
+    face_locations = detect_face_locations(rgb_small, cnn_upsample=0)
+
     if not face_locations:
         raise HTTPException(status_code=400, detail="No face detected in the ID card image")
-    
+
+    # Map detection boxes back to full resolution
+    face_locations = scale_face_locations(face_locations, scale)
+
     # Get the largest face for ID card
-    face_location = max(face_locations, key=lambda loc: (loc[2] - loc[0]) * (loc[3] - loc[1]))
+    face_location = max(face_locations, key=face_area)
     top, right, bottom, left = face_location
     
     # Add margin
@@ -60,20 +252,17 @@ def detect_face_id(image):
         max(0, left - margin_x):min(width, right + margin_x)
     ]
     
-    # Get face encoding
+    # Get face encoding as a contiguous float32 array so downstream
+    # distance math runs on it directly without re-conversion
     face_encoding = face_recognition.face_encodings(rgb_image, [face_location], num_jitters=3)[0]
-    
+    face_encoding = np.ascontiguousarray(face_encoding, dtype=np.float32)
+
     # Standardize face size
     face_roi = cv2.resize(face_roi, (160, 160))
     
     return face_roi, face_encoding, {
         'confidence': 1.0,
-        'box': {
-            'x': int(left),
-            'y': int(top),
-            'width': int(right - left),
-            'height': int(bottom - top)
-        }
+        'box': face_box(top, right, bottom, left)
     }
 
 def detect_faces_in_photo(image) -> List[Dict]:
@@ -81,145 +270,217 @@ def detect_faces_in_photo(image) -> List[Dict]:
     if image is None:
         raise HTTPException(status_code=400, detail="Invalid image data")
     
-    # Convert BGR to RGB
+    # Convert BGR to RGB once; the detection copy is resized from the
+    # already-converted image rather than converted a second time
     rgb_image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-    
-    # Detect faces using CNN model
-    face_locations = face_recognition.face_locations(rgb_image, model="cnn", number_of_times_to_upsample=1)
-    
-    if not face_locations:
-        # Try HOG model if CNN fails
-        face_locations = face_recognition.face_locations(rgb_image, model="hog", number_of_times_to_upsample=2)
-    
+
+    # Detect on a downscaled copy; encoding and ROI extraction below still
+    # use the full-resolution image
+    rgb_small, scale = downscale_for_detection(rgb_image)
+
+    face_locations = detect_face_locations(rgb_small, cnn_upsample=1)
+
     if not face_locations:
         raise HTTPException(status_code=400, detail="No faces detected in the photo")
-    
+
+    # Map detection boxes back to full resolution
+    face_locations = scale_face_locations(face_locations, scale)
+
+    # Largest face first: the closest subject is the most likely match,
+    # so downstream consumers can stop at the first confident hit
+    face_locations = sorted(face_locations, key=face_area, reverse=True)
+
+    height, width = image.shape[:2]
+
+    # Encode every face in one batched call so dlib amortizes the ResNet
+    # dispatch over all faces instead of being invoked once per face.
+    # No jitter here: jittering is a variance reducer for the canonical
+    # reference embedding (the ID face keeps num_jitters=3); the probe
+    # side of a best-match search doesn't benefit from the extra passes
+    face_encodings = face_recognition.face_encodings(rgb_image, face_locations, num_jitters=0)
+
+    # One batched cast: the float64 encodings become a single contiguous
+    # (N, 128) float32 matrix and each face keeps a row view of it
+    face_encodings = np.asarray(face_encodings, dtype=np.float32)
+
     faces = []
-    for face_location in face_locations:
+    for face_location, face_encoding in zip(face_locations, face_encodings):
         top, right, bottom, left = face_location
-        
+
         # Add margin
-        height, width = image.shape[:2]
         margin_x = int((right - left) * 0.3)
         margin_y = int((bottom - top) * 0.3)
         
-        # Extract face ROI with margin
+        # Extract face ROI with margin and bound it to display scale, so
+        # results (which may be cached) never pin the full decoded frame
+        # or a full-resolution crop of it in memory
         face_roi = image[
             max(0, top - margin_y):min(height, bottom + margin_y),
             max(0, left - margin_x):min(width, right + margin_x)
         ]
-        
-        # Get face encoding
-        face_encoding = face_recognition.face_encodings(rgb_image, [face_location], num_jitters=3)[0]
-        
-        # Standardize face size for display
-        face_roi_display = cv2.resize(face_roi, (160, 160))
-        
+        roi_scale = MAX_ROI_EDGE / max(face_roi.shape[:2])
+        if roi_scale < 1.0:
+            face_roi = cv2.resize(face_roi, None, fx=roi_scale, fy=roi_scale, interpolation=cv2.INTER_AREA)
+        else:
+            face_roi = np.ascontiguousarray(face_roi)
+
         faces.append({
-            'roi': face_roi_display,
+            'roi': face_roi,
             'encoding': face_encoding,
-            'box': {
-                'x': int(left),
-                'y': int(top),
-                'width': int(right - left),
-                'height': int(bottom - top)
-            }
+            'box': face_box(top, right, bottom, left)
         })
     
     return faces
 
+# Numba is optional: when installed, the pairwise distance kernel compiles
+# to a single SIMD reduction loop (cached on disk, so the JIT cost is paid
+# once); otherwise NumPy handles the 128-d vectors directly.
+try:
+    from numba import njit
+
+    @njit('f4(f4[::1], f4[::1])', fastmath=True, cache=True)
+    def _encoding_distance(encoding1, encoding2):
+        total = np.float32(0.0)
+        for i in range(encoding1.shape[0]):
+            diff = encoding1[i] - encoding2[i]
+            total += diff * diff
+        return np.sqrt(total)
+except ImportError:
+    def _encoding_distance(encoding1, encoding2):
+        return np.linalg.norm(encoding1 - encoding2)
+
 def compare_face_encodings(encoding1, encoding2) -> float:
     """Compare two face encodings and return similarity score"""
-    # Calculate face distance with multiple samples for robustness
-    distances = []
-    for _ in range(5):
-        distance = face_recognition.face_distance([encoding1], encoding2)[0]
-        distances.append(distance)
-    
-    # Use the best (minimum) distance
-    face_distance = min(distances)
-    
+    encoding1 = np.ascontiguousarray(encoding1, dtype=np.float32)
+    encoding2 = np.ascontiguousarray(encoding2, dtype=np.float32)
+
+    # The distance is deterministic, so one computation suffices
+    face_distance = _encoding_distance(encoding1, encoding2)
+
     # Convert distance to similarity score (0-100)
     return (1 - face_distance) * 100
 
+# Similarity bands for analyze_similarity, precomputed so the hot path is
+# a single bisect plus a tuple lookup instead of a chain of branches and
+# list appends. A score lands in the band whose index equals the number of
+# thresholds strictly below it.
+_BAND_THRESHOLDS = [55, 60, 65, 75]
+_BANDS = [
+    (False, ". ".join([
+        "Faces appear to be different",
+        "Significant differences in key facial features"]) + "."),
+    (True, ". ".join([
+        "Possible match with some variations",
+        "Core facial features show similarity despite differences",
+        "Differences may be due to age, expression, lighting, or angle"]) + "."),
+    (True, ". ".join([
+        "Possible match with some variations",
+        "Core facial features show similarity despite differences",
+        "Differences may be due to age, expression, lighting, or angle",
+        "Despite variations, underlying facial structure shows consistency"]) + "."),
+    (True, "High confidence match - facial features align strongly."),
+    (True, ". ".join([
+        "High confidence match - facial features align strongly",
+        "Very strong match with consistent core facial features"]) + "."),
+]
+
+# Matches above this score are high-confidence (the 65 band boundary
+# above); the best-match search stops at the first candidate clearing it
+HIGH_CONFIDENCE_SIMILARITY = 65
+
 def analyze_similarity(similarity: float) -> Dict:
     """Generate analysis based on similarity score"""
-    threshold = 55
-    high_confidence_threshold = 65
-    
-    analysis = []
-    if similarity > high_confidence_threshold:
-        analysis.append("High confidence match - facial features align strongly")
-        if similarity > 75:
-            analysis.append("Very strong match with consistent core facial features")
-    elif similarity > threshold:
-        analysis.append("Possible match with some variations")
-        analysis.append("Core facial features show similarity despite differences")
-    else:
-        analysis.append("Faces appear to be different")
-        analysis.append("Significant differences in key facial features")
-    
-    if threshold < similarity < high_confidence_threshold:
-        analysis.append("Differences may be due to age, expression, lighting, or angle")
-        if similarity > 60:
-            analysis.append("Despite variations, underlying facial structure shows consistency")
-    
+    match, analysis = _BANDS[bisect.bisect_left(_BAND_THRESHOLDS, similarity)]
     return {
-        'match': bool(similarity > threshold),
+        'match': match,
         'confidence': round(float(similarity), 2),
-        'analysis': ". ".join(analysis) + "."
+        'analysis': analysis
     }
 
-def save_face_image(face_img, prefix):
-    os.makedirs('uploads', exist_ok=True)
-    filename = f"{prefix}_{os.urandom(8).hex()}.jpg"
-    filepath = os.path.join('uploads', filename)
-    cv2.imwrite(filepath, face_img)
-    return filename
+def encode_face_data_url(face_img):
+    """JPEG-encode a face crop and return it as an inline data URL"""
+    ok, buffer = cv2.imencode('.jpg', face_img, [cv2.IMWRITE_JPEG_QUALITY, 85])
+    if not ok:
+        raise HTTPException(status_code=500, detail="Failed to encode face image")
+    return 'data:image/jpeg;base64,' + base64.b64encode(buffer).decode()
+
+@app.on_event("startup")
+async def warm_up_models():
+    """Run the detector, encoder and compare kernel once on dummy data so
+    the first real request doesn't pay one-time initialization costs
+    (pyramid allocations, BLAS thread pools, numba compilation)"""
+    def warm_up():
+        dummy = np.zeros((MAX_DETECTION_EDGE, MAX_DETECTION_EDGE, 3), dtype=np.uint8)
+        detect_face_locations(dummy, cnn_upsample=0)
+        face_recognition.face_encodings(dummy, [(0, 64, 64, 0)], num_jitters=0)
+        zero_encoding = np.zeros(128, dtype=np.float32)
+        compare_face_encodings(zero_encoding, zero_encoding)
+
+    await asyncio.to_thread(warm_up)
+
+class FaceMatchRequest(BaseModel):
+    expectedImage: str
+    actualImage: str
 
 @app.post("/api/match-faces")
-async def match_faces(request_data: dict):
+async def match_faces(request_data: FaceMatchRequest):
     try:
-        # Extract base64 images
-        id_image = decode_base64_image(request_data['expectedImage'])
-        photo_image = decode_base64_image(request_data['actualImage'])
-        
-        # Detect face in ID card
-        id_face, id_encoding, id_detection = detect_face_id(id_image)
-        
-        # Detect all faces in photo
-        detected_faces = detect_faces_in_photo(photo_image)
-        
-        # Find best matching face
-        best_match = None
-        best_similarity = 0
-        
-        for face in detected_faces:
-            similarity = compare_face_encodings(id_encoding, face['encoding'])
-            if similarity > best_similarity:
-                best_similarity = similarity
-                best_match = face
+        # Each image runs decode + detection as one worker-thread task so
+        # the images flow through both stages fully in parallel, with no
+        # synchronization barrier between decoding and detection
+        def process_id_image():
+            return detect_with_cache('id', request_data.expectedImage, detect_face_id)
+
+        def process_photo_image():
+            return detect_with_cache('photo', request_data.actualImage, detect_faces_in_photo)
+
+        loop = asyncio.get_running_loop()
+        (id_face, id_encoding, id_detection), detected_faces = await asyncio.gather(
+            loop.run_in_executor(_detection_executor, process_id_image),
+            loop.run_in_executor(_detection_executor, process_photo_image)
+        )
         
-        if not best_match:
+        # Find best matching face: stack all photo encodings and compute
+        # every distance in one vectorized NumPy call instead of looping
+        photo_encodings = np.stack([face['encoding'] for face in detected_faces])
+        distances = np.linalg.norm(photo_encodings - id_encoding, axis=1)
+        similarities = (1 - distances) * 100
+
+        # Candidates arrive sorted largest-first, so take the first face
+        # that clears the high-confidence bar - the closest subject wins
+        # over a marginally higher score on a background face - and fall
+        # back to the overall best score when nothing clears it
+        confident = np.flatnonzero(similarities > HIGH_CONFIDENCE_SIMILARITY)
+        best_index = int(confident[0]) if confident.size else int(np.argmax(similarities))
+        best_similarity = float(similarities[best_index])
+        best_match = detected_faces[best_index]
+
+        if best_similarity <= 0:
             raise HTTPException(status_code=400, detail="No matching face found in the photo")
         
         # Generate analysis for best match
         comparison_result = analyze_similarity(best_similarity)
         
-        # Save face images
-        id_face_filename = save_face_image(id_face, 'id')
-        photo_face_filename = save_face_image(best_match['roi'], 'photo')
+        # Crops are bounded to MAX_ROI_EDGE at detection time, so the
+        # winning face goes straight to JPEG encoding
+        best_face_roi = best_match['roi']
+
+        # Inline the face crops as JPEG data URLs: no disk write on the
+        # request path, nothing to re-serve through StaticFiles, and no
+        # unbounded uploads directory growth
+        id_face_url = encode_face_data_url(id_face)
+        photo_face_url = encode_face_data_url(best_face_roi)
         
         return {
             'match': bool(comparison_result['match']),
             'confidence': float(comparison_result['confidence']),
             'analysis': str(comparison_result['analysis']),
             'idCardFace': {
-                'url': f'/uploads/{id_face_filename}',
+                'url': id_face_url,
                 'box': id_detection['box']
             },
             'photoFace': {
-                'url': f'/uploads/{photo_face_filename}',
+                'url': photo_face_url,
                 'box': best_match['box']
             }
         }
@@ -227,8 +488,6 @@ async def match_faces(request_data: dict):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-# Serve static files
-app.mount("/uploads", StaticFiles(directory="uploads"), name="uploads")
 
 if __name__ == "__main__":
     import uvicorn
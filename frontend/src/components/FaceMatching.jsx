@@ -186,7 +186,7 @@ const FaceMatching = () => {
                                     </div>
                                     <div className="extracted-face">
                                         <img 
-                                            src={`http://localhost:3002${result.idCardFace.url}`} 
+                                            src={result.idCardFace.url} 
                                             alt="Extracted ID Card Face" 
                                         />
                                     </div>
@@ -207,7 +207,7 @@ const FaceMatching = () => {
                                     </div>
                                     <div className="extracted-face">
                                         <img 
-                                            src={`http://localhost:3002${result.photoFace.url}`} 
+                                            src={result.photoFace.url} 
                                             alt="Extracted Photo Face" 
                                         />
                                     </div>